@@ -53,6 +53,14 @@ login_template = """
     <a target="_blank" href="/positions.json"><h4>Fetch user positions</h4></a>
     <a target="_blank" href="https://kite.trade/docs/connect/v1/"><h4>Checks Kite Connect docs for other calls.</h4></a>"""
 
+# The index page only depends on module level settings, so render it once.
+index_html = index_template.format(
+    api_key=kite_api_key,
+    redirect_url=redirect_url,
+    console_url=console_url,
+    login_url=login_url
+)
+
 
 def get_kite_client():
     """Returns a kite client object
@@ -65,12 +73,7 @@ def get_kite_client():
 
 @app.route("/")
 def index():
-    return index_template.format(
-        api_key=kite_api_key,
-        redirect_url=redirect_url,
-        console_url=console_url,
-        login_url=login_url
-    )
+    return index_html
 
 
 @app.route("/login")
@@ -88,10 +91,6 @@ def login():
     data = kite.generate_session(request_token, api_secret=kite_api_secret)
     session["access_token"] = data["access_token"]
 
-    # Write access token to .env
-    with open(".env", "a") as env_file:
-        env_file.write(f"ACCESS_TOKEN={data['access_token']}\n")
-
     return login_template.format(
         access_token=data["access_token"],
         user_data=json.dumps(
@@ -1,46 +1,137 @@
 import os
 import json
+import asyncio
 import logging
+import secrets
+import hashlib
+import importlib.util
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import date, datetime
 from decimal import Decimal
 
+import orjson
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from starlette.middleware.sessions import SessionMiddleware
 from dotenv import load_dotenv
 
-try:
-    from kiteconnect import KiteConnect
-except Exception as e:
-    KiteConnect = None
-    _kite_import_error = e
-else:
-    _kite_import_error = None
+# kiteconnect (and the websocket stack it pulls in) is imported on first use
+# in need_kite(); at startup we only check that the package is present, which
+# does not prove its own dependencies import cleanly.
+_KiteConnect = None
+_kite_installed = importlib.util.find_spec("kiteconnect") is not None
 
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
 
-app = FastAPI(title="Kite FastAPI Service", docs_url="/docs", redoc_url="/redoc")
-app.add_middleware(SessionMiddleware, secret_key=os.urandom(24))
-
 def serializer(obj):
     if isinstance(obj, (date, datetime, Decimal)):
         return str(obj)
     raise TypeError(f"Type {type(obj)} not serializable")
 
+def dump_json(content) -> bytes:
+    # orjson encodes the datetimes in Kite payloads natively; serializer()
+    # only has to cover the rest (Decimal).
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS, default=serializer)
+
+class KiteJSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+def make_kite_session() -> requests.Session:
+    """
+    One pooled session per process, shared by every KiteConnect client, so
+    calls to api.kite.trade reuse keep-alive connections instead of doing a
+    fresh TCP+TLS handshake per request.
+    """
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504), raise_on_status=False)
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retry))
+    return session
+
+_MIN_SECRET_LEN = 32
+
+def load_session_secret() -> str:
+    """
+    SESSION_SECRET from env; otherwise a random key persisted to
+    SESSION_SECRET_FILE so restarts and sibling workers keep sessions valid.
+    The file is written to a temp path and linked into place, so a reader
+    never sees it half-written.
+    """
+    secret = os.getenv("SESSION_SECRET")
+    if secret:
+        if len(secret) < _MIN_SECRET_LEN:
+            raise RuntimeError(f"SESSION_SECRET must be at least {_MIN_SECRET_LEN} characters")
+        return secret
+    path = os.getenv("SESSION_SECRET_FILE", ".session_secret")
+    secret = secrets.token_hex(32)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secret)
+            f.flush()
+            os.fsync(f.fileno())
+        # link() fails if another worker got there first, unlike replace(),
+        # so every worker ends up signing with the same key.
+        os.link(tmp, path)
+    except FileExistsError:
+        with open(path) as f:
+            secret = f.read().strip()
+    except OSError as e:
+        logging.warning("Couldn't persist session secret to %s: %s", path, e)
+    finally:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    if len(secret) < _MIN_SECRET_LEN:
+        raise RuntimeError(f"Session secret in {path} is empty or too short; delete it or set SESSION_SECRET")
+    return secret
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.kite_session = make_kite_session()
+    # Blocking Kite calls get their own small pool: it caps concurrent upstream
+    # calls and keeps them from starving the default executor.
+    app.state.kite_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="kite")
+    try:
+        yield
+    finally:
+        app.state.kite_executor.shutdown(wait=False, cancel_futures=True)
+        app.state.kite_session.close()
+
+app = FastAPI(title="Kite FastAPI Service", docs_url="/docs", redoc_url="/redoc",
+              default_response_class=KiteJSONResponse, lifespan=lifespan)
+app.add_middleware(SessionMiddleware, secret_key=load_session_secret())
+
 kite_api_key = os.getenv("KITE_API_KEY", "kite_api_key")
 kite_api_secret = os.getenv("KITE_API_SECRET", "kite_api_secret")
 
 login_url = f"https://kite.zerodha.com/connect/login?api_key={kite_api_key}"
 console_url = f"https://developers.kite.trade/apps/{kite_api_key}"
 
+PUBLIC_PREFIX = os.getenv("PUBLIC_PREFIX", "").rstrip("/")
+
 def get_prefix(request: Request) -> str:
     """
     Prefer proxy-provided prefix; fallback to env (optional).
     Result never ends with a trailing slash.
     """
-    p = request.headers.get("x-forwarded-prefix") or os.getenv("PUBLIC_PREFIX", "")
-    return p.rstrip("/")
+    # ASGI header names are already lowercased bytes; scan them directly
+    # rather than building a Headers object per request.
+    for name, value in request.scope["headers"]:
+        if name == b"x-forwarded-prefix":
+            if value:
+                return value.decode("latin-1").rstrip("/")
+            break
+    return PUBLIC_PREFIX
 
 def page_index(prefix: str) -> str:
     # base makes *relative* links resolve under /py/ automatically
@@ -50,6 +141,11 @@ def page_index(prefix: str) -> str:
     <div>If not, set it from your <a href="{console_url}">Kite Connect developer console</a>.</div>
     <a href="{login_url}"><h1>Login to generate access token.</h1></a>"""
 
+@lru_cache(maxsize=8)
+def index_body(prefix: str) -> tuple:
+    body = page_index(prefix).encode()
+    return body, etag_for(body)
+
 def page_login_success(access_token: str, user_data: dict, prefix: str) -> str:
     return f"""
     <head><base href="{prefix + '/' if prefix else '/'}"></head>
@@ -62,25 +158,68 @@ def page_login_success(access_token: str, user_data: dict, prefix: str) -> str:
     <a target="_blank" href="positions.json"><h4>Fetch user positions</h4></a>
     <a target="_blank" href="https://kite.trade/docs/connect/v1/"><h4>Check Kite Connect docs</h4></a>"""
 
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison over a comma-separated list (RFC 9110 13.1.2).
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def conditional_response(request: Request, body: bytes, etag: str, media_type: str,
+                         vary: str = None) -> Response:
+    """
+    Serve body with a short private cache lifetime, or an empty 304 when the
+    client already holds this version.
+    """
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=5"}
+    if vary:
+        headers["Vary"] = vary
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=media_type, headers=headers)
+
 def need_kite():
-    if _kite_import_error:
-        raise RuntimeError(f"kiteconnect is not installed: {_kite_import_error}")
-    return KiteConnect(api_key=kite_api_key)
+    global _KiteConnect
+    if _KiteConnect is None:
+        try:
+            from kiteconnect import KiteConnect
+        except Exception as e:
+            raise RuntimeError(f"kiteconnect is not installed: {e}") from e
+        _KiteConnect = KiteConnect
+    return _KiteConnect(api_key=kite_api_key)
 
 def get_kite_client(request: Request):
     kite = need_kite()
-    if "access_token" in request.session:
-        kite.set_access_token(request.session["access_token"])
+    kite.reqsession = request.app.state.kite_session
+    access_token = request.session.get("access_token")
+    if access_token:
+        kite.set_access_token(access_token)
     return kite
 
+async def call_kite(request: Request, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app.state.kite_executor, partial(fn, *args, **kwargs))
+
+# Nothing in the health payload changes after import, so encode it once.
+_HEALTH_BYTES = json.dumps({"status": "healthy", "kite_import_ok": _kite_installed}).encode()
+
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "kite_import_ok": _kite_import_error is None}
+    """
+    Liveness check. kite_import_ok only means the kiteconnect package is
+    installed; it is not imported here, so a broken dependency of it first
+    shows up as an error on the Kite endpoints.
+    """
+    return Response(_HEALTH_BYTES, media_type="application/json")
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     prefix = get_prefix(request)
-    return page_index(prefix)
+    return conditional_response(request, *index_body(prefix), "text/html; charset=utf-8")
 
 @app.get("/login", response_class=HTMLResponse)
 async def login(request: Request):
@@ -91,28 +230,57 @@ async def login(request: Request):
         return "<span style='color:red'>Error while generating request token.</span> <a href='./'>Try again.</a>"
 
     kite = get_kite_client(request)
-    data = kite.generate_session(request_token, api_secret=kite_api_secret)
+    data = await call_kite(request, kite.generate_session, request_token, api_secret=kite_api_secret)
+    # The signed session cookie is the token store; nothing reads it back from .env.
     request.session["access_token"] = data["access_token"]
 
+    return page_login_success(data["access_token"], data, prefix)
+
+# Positions/holdings barely move between dashboard polls, so keep the encoded
+# body per (access_token, endpoint) for a couple of seconds.
+_snapshot_cache = TTLCache(maxsize=1024, ttl=2)
+_snapshot_inflight = {}
+
+async def fetch_snapshot(request: Request, kite, key: tuple, name: str) -> tuple:
     try:
-        with open(".env", "a") as env_file:
-            env_file.write(f"ACCESS_TOKEN={data['access_token']}\n")
-    except Exception as e:
-        logging.warning("Couldn't append ACCESS_TOKEN to .env: %s", e)
+        body = dump_json({name: await call_kite(request, getattr(kite, name))})
+        entry = _snapshot_cache[key] = (body, etag_for(body))
+        return entry
+    finally:
+        _snapshot_inflight.pop(key, None)
 
-    return page_login_success(data["access_token"], data, prefix)
+async def cached_snapshot(request: Request, name: str) -> tuple:
+    """Return the (body, etag) pair for a Kite snapshot endpoint."""
+    kite = get_kite_client(request)
+    if not kite.access_token:
+        body = dump_json({name: await call_kite(request, getattr(kite, name))})
+        return body, etag_for(body)
+
+    key = (kite.access_token, name)
+    entry = _snapshot_cache.get(key)
+    if entry is not None:
+        return entry
+    # Single-flight: concurrent misses for the same key share one fetch task,
+    # so its result or its exception reaches every caller at once. shield()
+    # keeps one caller disconnecting from cancelling the fetch for the rest.
+    task = _snapshot_inflight.get(key)
+    if task is None:
+        task = _snapshot_inflight[key] = asyncio.create_task(fetch_snapshot(request, kite, key, name))
+    return await asyncio.shield(task)
 
 @app.get("/holdings.json")
 async def holdings(request: Request):
-    kite = get_kite_client(request)
-    return JSONResponse({"holdings": kite.holdings()})
+    body, etag = await cached_snapshot(request, "holdings")
+    # Holdings change slowly; let the browser revalidate instead of re-downloading.
+    # The body depends on whose session cookie came in.
+    return conditional_response(request, body, etag, "application/json", vary="Cookie")
 
 @app.get("/orders.json")
 async def orders(request: Request):
     kite = get_kite_client(request)
-    return JSONResponse({"orders": kite.orders()})
+    return KiteJSONResponse({"orders": await call_kite(request, kite.orders)})
 
 @app.get("/positions.json")
 async def positions(request: Request):
-    kite = get_kite_client(request)
-    return JSONResponse({"positions": kite.positions()})
+    body, _ = await cached_snapshot(request, "positions")
+    return Response(body, media_type="application/json")